@@ -3,16 +3,281 @@ FHIR Server Uploader
 Uploads processed FHIR bundles to FHIR server with custom authentication
 """
 
+import hashlib
 import json
+import mmap
 import os
+import re
+import sqlite3
+import sys
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Optional
-import requests
-from requests.adapters import HTTPAdapter
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+import urllib3
 from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+try:
+    # ISA-L gzip is several times faster than zlib and API compatible
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# Attempts made after a 429 before an upload is reported as failed
+MAX_THROTTLE_RETRIES = 5
+
+# Resources per transaction Bundle when uploading NDJSON files
+NDJSON_CHUNK_SIZE = 200
+
+# Structure the server requires of a posted Bundle; checked locally to save a 4xx round trip
+BUNDLE_SCHEMA = {
+    'type': 'object',
+    'required': ['resourceType', 'type'],
+    'properties': {
+        'resourceType': {'const': 'Bundle'},
+        'type': {'enum': ['transaction', 'batch']},
+        'entry': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'required': ['request'],
+                'properties': {
+                    'resource': {
+                        'type': 'object',
+                        'required': ['resourceType'],
+                        'properties': {'resourceType': {'type': 'string'}}
+                    },
+                    'request': {
+                        'type': 'object',
+                        'required': ['method', 'url'],
+                        'properties': {
+                            'method': {'enum': ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH']},
+                            'url': {'type': 'string'}
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+# Compiled once at import; None when fastjsonschema is not installed
+_validate_bundle = fastjsonschema.compile(BUNDLE_SCHEMA) if fastjsonschema is not None else None
+
+# Transaction bundle files up to this size may be merged with their neighbours
+MERGE_FILE_MAX_BYTES = 16 * 1024
+
+# Consecutive JSON files handed to one worker to merge
+MERGE_GROUP_MAX_FILES = 100
+
+# Bundle files at least this large are memory-mapped instead of read into memory
+MMAP_MIN_BYTES = 1 << 20
+
+# Leading bytes of a JSON file checked for a non-Bundle resourceType before parsing
+BUNDLE_SNIFF_BYTES = 512
+
+_RESOURCE_TYPE_PATTERN = re.compile(rb'"resourceType"\s*:\s*"([^"]*)"')
+
+
+def _json_loads(data):
+    """Parse JSON bytes or a buffer (e.g. an mmap), using orjson when it is installed"""
+    
+    if orjson is not None:
+        # orjson parses any contiguous buffer in place through a memoryview
+        return orjson.loads(data if isinstance(data, (bytes, bytearray, str)) else memoryview(data))
+    return json.loads(data if isinstance(data, (bytes, bytearray, str)) else bytes(data))
+
+
+def _json_dumps(obj) -> bytes:
+    """Serialize to compact JSON bytes, using orjson when it is installed"""
+    
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Convert a Retry-After header (seconds or HTTP date) into seconds to wait"""
+    
+    if not value:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _count_resources(resources, counts: Dict[str, int]) -> None:
+    """Add the Patient/Observation/MedicationStatement totals of resources to counts"""
+    
+    # Counter tallies in C; one pass instead of a branch chain per resource
+    type_counts = Counter(resource.get('resourceType') for resource in resources)
+    counts['patients'] += type_counts['Patient']
+    counts['observations'] += type_counts['Observation']
+    counts['medications'] += type_counts['MedicationStatement']
+
+
+def _transaction_bundle(resources: List[Dict]) -> Dict:
+    """Wrap standalone resources in a transaction Bundle (PUT when an id is present)"""
+    
+    entries = []
+    for resource in resources:
+        resource_type = resource['resourceType']
+        if 'id' in resource:
+            request = {'method': 'PUT', 'url': f"{resource_type}/{resource['id']}"}
+        else:
+            request = {'method': 'POST', 'url': resource_type}
+        entries.append({'resource': resource, 'request': request})
+    
+    return {'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries}
+
+
+@contextmanager
+def _read_file(file_path: Path):
+    """Yield a file's contents; large files are memory-mapped rather than copied"""
+    
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_BYTES:
+            yield f.read()
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+
+def _declares_other_resource(data: bytes) -> bool:
+    """
+    Cheap byte-level check for JSON that is clearly not a FHIR Bundle, without parsing it
+    
+    Only a top-level resourceType other than Bundle in the leading bytes counts.
+    Key order is not fixed, so a head without one is inconclusive and passes.
+    """
+    
+    head = data[:BUNDLE_SNIFF_BYTES]
+    for match in _RESOURCE_TYPE_PATTERN.finditer(head):
+        prefix = head[:match.start()]
+        depth = prefix.count(b'{') + prefix.count(b'[') - prefix.count(b'}') - prefix.count(b']')
+        if depth == 1:
+            return match.group(1) != b'Bundle'
+    return False
+
+
+def _file_digest(file_path: Path) -> str:
+    """Content digest of a file, read in chunks so large files stay out of memory"""
+    
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileResult(NamedTuple):
+    """Outcome of uploading one file from a directory"""
+    
+    success: bool
+    counts: Dict[str, int]
+    digest: Optional[str] = None
+    response_id: Optional[str] = None
+    skipped: Optional[str] = None  # reason the file was not uploaded
+
+
+class RateController:
+    """Adaptive (AIMD) limit on concurrent uploads driven by server throttling"""
+    
+    def __init__(self,
+                 max_concurrency: int,
+                 min_concurrency: int = 1,
+                 increase: float = 0.5,
+                 decrease: float = 0.5):
+        """
+        Initialize rate controller
+        
+        Args:
+            max_concurrency: Upper bound on uploads in flight
+            min_concurrency: Lower bound the limit never drops below
+            increase: Amount added to the limit after each accepted upload
+            decrease: Factor the limit is multiplied by when throttled
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(max_concurrency)
+        
+        self._active = 0
+        self._last_decrease = float('-inf')
+        self._condition = threading.Condition()
+    
+    def __enter__(self):
+        """Wait for a free upload slot under the current limit"""
+        
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+    
+    def on_success(self, headers) -> None:
+        """Additively raise the limit unless the server reports an exhausted quota"""
+        
+        with self._condition:
+            if headers.get('X-RateLimit-Remaining') == '0':
+                return
+            self.limit = min(self.max_concurrency, self.limit + self.increase)
+            self._condition.notify_all()
+    
+    def on_throttle(self, headers, default_delay: float, started_at: float) -> float:
+        """
+        Multiplicatively lower the limit after a 429 response
+        
+        Requests already in flight when the limit was last lowered were sent
+        under the old limit, so their 429s are part of the same throttling
+        event and do not lower it again.
+        
+        Args:
+            headers: Response headers of the throttled request
+            default_delay: Backoff used when the server sends no Retry-After
+            started_at: time.monotonic() when the throttled request was sent
+            
+        Returns:
+            Seconds to wait before retrying
+        """
+        
+        with self._condition:
+            if started_at >= self._last_decrease:
+                self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                self._last_decrease = time.monotonic()
+        
+        retry_after = _parse_retry_after(headers.get('Retry-After'))
+        return default_delay if retry_after is None else retry_after
+
 
 class FHIRUploader:
     """Upload FHIR resources to server with custom authentication"""
@@ -22,7 +287,12 @@ class FHIRUploader:
                  client_id: str,
                  client_secret: str,
                  batch_size: int = 10,
-                 delay_seconds: float = 0.5):
+                 delay_seconds: float = 0.5,
+                 workers: int = 8,
+                 pool_size: Optional[int] = None,
+                 state_path: Optional[str] = '.fhir_upload.state',
+                 gzip_min_bytes: int = 4096,
+                 merge_max_bytes: int = 1_000_000):
         """
         Initialize FHIR uploader
         
@@ -31,100 +301,197 @@ class FHIRUploader:
             client_id: Access Client ID
             client_secret: Access Client Secret
             batch_size: Number of bundles to upload before progress update
-            delay_seconds: Delay between uploads to avoid rate limiting
+            delay_seconds: Backoff after a 429 response without a Retry-After header
+            workers: Number of bundles uploaded concurrently
+            pool_size: Keep-alive connections to the server (default: workers)
+            state_path: SQLite file recording files uploaded to each server so
+                reruns against the same server skip them (None disables resuming)
+            gzip_min_bytes: Gzip request bodies larger than this (0 disables)
+            merge_max_bytes: Combined size up to which small transaction bundles
+                are merged into one POST (0 disables)
         """
         self.base_url = f"https://{hostname}/fhir/R4"
         self.client_id = client_id
         self.client_secret = client_secret
         self.batch_size = batch_size
         self.delay_seconds = delay_seconds
+        self.workers = max(1, workers)
+        self.pool_size = pool_size or self.workers
+        self.state_path = state_path
+        self.gzip_min_bytes = gzip_min_bytes
+        self.merge_max_bytes = merge_max_bytes
+        
+        # Headers never change, so build them once instead of per request
+        self._headers = {
+            'Content-Type': 'application/fhir+json',
+            'Accept': 'application/fhir+json',
+            'Accept-Encoding': 'gzip',
+            'CF-Access-Client-Id': self.client_id,
+            'CF-Access-Client-Secret': self.client_secret
+        }
         
-        # Setup session with retries
-        self.session = self._create_session()
+        # Adapts upload concurrency to the server's rate limiting
+        self.rate_controller = RateController(self.workers)
         
-    def _create_session(self) -> requests.Session:
-        """Create requests session with retry logic"""
+        # Setup connection pool with retries
+        self.pool = self._create_pool()
         
-        session = requests.Session()
+    def _create_pool(self) -> urllib3.PoolManager:
+        """Create urllib3 connection pool with retry logic"""
         
         # Retry strategy
         retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["POST", "GET"]
+            # Uploads carry an idempotency key, so POSTs can be retried eagerly
+            total=6,
+            backoff_factor=0.25,
+            # 429 and Retry-After are left to RateController so throttling
+            # also lowers concurrency
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["POST", "GET"],
+            respect_retry_after_header=False,
+            # Hand back the last error response instead of raising MaxRetryError
+            raise_on_status=False
         )
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
-        
-        return session
+        # At most `workers` requests are in flight, so a pool of that size keeps one
+        # warm connection per worker and opens no more. Blocking enforces the cap
+        # when pool_size is set below the worker count, instead of opening
+        # throwaway connections (and TLS handshakes) on overflow
+        return urllib3.PoolManager(
+            num_pools=1,
+            maxsize=self.pool_size,
+            block=True,
+            retries=retry_strategy
+        )
     
     def _get_headers(self) -> Dict[str, str]:
-        """Get request headers with authentication"""
+        """Get request headers with authentication (shared dict, do not mutate)"""
         
-        return {
-            'Content-Type': 'application/fhir+json',
-            'Accept': 'application/fhir+json',
-            'CF-Access-Client-Id': self.client_id,
-            'CF-Access-Client-Secret': self.client_secret
-        }
+        return self._headers
+    
+    def _open_state(self) -> Optional[sqlite3.Connection]:
+        """Open the upload checkpoint database, or None when resuming is disabled"""
+        
+        if not self.state_path:
+            return None
+        
+        state = sqlite3.connect(self.state_path)
+        
+        # Checkpoints written before uploads were keyed by server can't say
+        # where a file went, so they are discarded
+        columns = [row[1] for row in state.execute("PRAGMA table_info(uploads)")]
+        if columns and 'base_url' not in columns:
+            state.execute("DROP TABLE uploads")
+        
+        state.execute(
+            "CREATE TABLE IF NOT EXISTS uploads "
+            "(base_url TEXT, path TEXT, digest TEXT, response_id TEXT, ts REAL, "
+            "PRIMARY KEY (base_url, path))"
+        )
+        return state
     
     def test_connection(self) -> bool:
         """Test connection to FHIR server"""
         
         try:
-            response = self.session.get(
+            response = self.pool.request(
+                'GET',
                 f"{self.base_url}/metadata",
                 headers=self._get_headers(),
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status == 200:
                 print("✓ Successfully connected to FHIR server")
-                metadata = response.json()
+                metadata = _json_loads(response.data)
                 print(f"  Server: {metadata.get('software', {}).get('name', 'Unknown')}")
                 print(f"  Version: {metadata.get('fhirVersion', 'Unknown')}")
                 return True
             else:
-                print(f"✗ Connection failed: {response.status_code}")
-                print(f"  Response: {response.text}")
+                print(f"✗ Connection failed: {response.status}")
+                print(f"  Response: {response.data.decode('utf-8', 'replace')}")
                 return False
                 
         except Exception as e:
             print(f"✗ Connection error: {str(e)}")
             return False
     
-    def upload_bundle(self, bundle: Dict) -> Optional[Dict]:
+    def upload_bundle(self,
+                      bundle: Union[Dict, bytes, mmap.mmap],
+                      name: Optional[str] = None) -> Optional[Dict]:
         """
         Upload a FHIR bundle to the server
         
         Args:
-            bundle: FHIR Bundle resource
+            bundle: FHIR Bundle resource, or its serialized JSON bytes (or mmap)
+            name: File the bundle came from, included in error messages
             
         Returns:
             Response from server or None if failed
         """
         
+        _, result = self._post_bundle(bundle, name)
+        return result
+    
+    def _post_bundle(self,
+                     bundle: Union[Dict, bytes, mmap.mmap],
+                     name: Optional[str] = None) -> Tuple[Optional[int], Optional[Dict]]:
+        """
+        Upload a FHIR bundle and report the final HTTP status
+        
+        Args:
+            bundle: See upload_bundle
+            name: See upload_bundle
+            
+        Returns:
+            Tuple of (HTTP status or None if no response was received,
+            response from server or None if failed)
+        """
+        
+        response = None
         try:
-            response = self.session.post(
-                self.base_url,
-                headers=self._get_headers(),
-                json=bundle,
-                timeout=30
-            )
+            # Serialize once; the Content-Type header is already set
+            body = _json_dumps(bundle) if isinstance(bundle, dict) else bundle
+            
+            # Same key on every retry lets the server drop duplicate transactions
+            headers = {**self._get_headers(), 'X-Idempotency-Key': hashlib.sha1(body).hexdigest()}
+            
+            # Level 1 keeps most of the ratio at a fraction of the default level's CPU
+            if self.gzip_min_bytes and len(body) > self.gzip_min_bytes:
+                body = gzip.compress(body, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+            elif not isinstance(body, bytes):
+                # urllib3 treats objects with read() as streams; send mapped files as bytes
+                body = bytes(body)
+            
+            for attempt in range(MAX_THROTTLE_RETRIES + 1):
+                with self.rate_controller:
+                    started_at = time.monotonic()
+                    response = self.pool.urlopen(
+                        'POST',
+                        self.base_url,
+                        body=body,
+                        headers=headers,
+                        timeout=30
+                    )
+                
+                if response.status != 429 or attempt == MAX_THROTTLE_RETRIES:
+                    break
+                
+                delay = self.rate_controller.on_throttle(response.headers, self.delay_seconds, started_at)
+                time.sleep(delay)
             
-            if response.status_code in [200, 201]:
-                return response.json()
+            if response.status in [200, 201]:
+                self.rate_controller.on_success(response.headers)
+                return response.status, _json_loads(response.data)
             else:
-                print(f"  Upload failed: {response.status_code}")
-                print(f"  Response: {response.text[:500]}")
-                return None
+                print(f"  Upload failed{f' for {name}' if name else ''}: {response.status}\n"
+                      f"  Response: {response.data[:500].decode('utf-8', 'replace')}")
+                return response.status, None
                 
         except Exception as e:
-            print(f"  Upload error: {str(e)}")
-            return None
+            print(f"  Upload error{f' for {name}' if name else ''}: {str(e)}")
+            return (response.status if response is not None else None), None
     
     def upload_bundle_file(self, file_path: Path) -> bool:
         """
@@ -138,10 +505,9 @@ class FHIRUploader:
         """
         
         try:
-            with open(file_path, 'r') as f:
-                bundle = json.load(f)
-            
-            result = self.upload_bundle(bundle)
+            # The file already holds serialized JSON, so post it as-is
+            with _read_file(file_path) as data:
+                result = self.upload_bundle(data, file_path.name)
             
             if result:
                 return True
@@ -152,19 +518,382 @@ class FHIRUploader:
             print(f"  Error processing file {file_path.name}: {str(e)}")
             return False
     
-    def upload_directory(self, directory: Path) -> Dict[str, int]:
+    def upload_ndjson_file(self, file_path: Path) -> bool:
+        """
+        Upload an NDJSON file (one resource per line, e.g. from $export)
+        
+        Args:
+            file_path: Path to FHIR NDJSON file
+            
+        Returns:
+            True if every chunk was uploaded, False otherwise
+        """
+        
+        success, _ = self._upload_ndjson(file_path)
+        return success
+    
+    def _upload_ndjson(self, file_path: Path) -> Tuple[bool, Dict[str, int]]:
+        """
+        Stream an NDJSON file into transaction Bundles of NDJSON_CHUNK_SIZE resources
+        
+        Args:
+            file_path: Path to FHIR NDJSON file
+            
+        Returns:
+            Tuple of (success, resource counts)
+        """
+        
+        counts = {'patients': 0, 'observations': 0, 'medications': 0}
+        success = True
+        chunk = []
+        
+        try:
+            with open(file_path, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    
+                    chunk.append(_json_loads(line))
+                    if len(chunk) == NDJSON_CHUNK_SIZE:
+                        _count_resources(chunk, counts)
+                        success = self.upload_bundle(_transaction_bundle(chunk), file_path.name) is not None and success
+                        chunk = []
+            
+            if chunk:
+                _count_resources(chunk, counts)
+                success = self.upload_bundle(_transaction_bundle(chunk), file_path.name) is not None and success
+                
+        except Exception as e:
+            print(f"  Error processing file {file_path.name}: {str(e)}")
+            return False, counts
+        
+        return success, counts
+    
+    def _upload_file(self,
+                     file_path: Path,
+                     count_resources: bool = True,
+                     uploaded: Optional[Dict[str, str]] = None) -> FileResult:
+        """
+        Upload one bundle file, optionally counting its resources (runs in a worker thread)
+        
+        Args:
+            file_path: Path to FHIR bundle JSON or NDJSON file
+            count_resources: Parse the bundle to validate it and count resources;
+                when False the file bytes are posted without being parsed
+            uploaded: Digests of previously uploaded files keyed by resolved path;
+                matching files are skipped (None disables the check)
+            
+        Returns:
+            FileResult for the file
+        """
+        
+        counts = {'patients': 0, 'observations': 0, 'medications': 0}
+        digest = None
+        
+        if file_path.suffix == '.ndjson':
+            if uploaded is not None:
+                digest = _file_digest(file_path)
+                if uploaded.get(str(file_path.resolve())) == digest:
+                    return FileResult(True, counts, digest, skipped='already uploaded')
+            
+            success, counts = self._upload_ndjson(file_path)
+            return FileResult(success, counts, digest)
+        
+        try:
+            with _read_file(file_path) as data:
+                return self._upload_bundle_data(file_path, data, count_resources, uploaded)
+        except OSError as e:
+            print(f"  Error processing file {file_path.name}: {str(e)}")
+            return FileResult(False, counts)
+    
+    def _prepare_bundle_data(self,
+                             file_path: Path,
+                             data,
+                             count_resources: bool,
+                             uploaded: Optional[Dict[str, str]]) -> Tuple[FileResult, Optional[Dict]]:
+        """
+        Filter, validate and count the contents of one bundle file
+        
+        Args:
+            file_path: Path the data was read from
+            data: File contents as bytes or a read-only mmap
+            count_resources: See _upload_file
+            uploaded: See _upload_file
+            
+        Returns:
+            Tuple of (result, parsed bundle). A skipped or failed result is final;
+            otherwise it is provisionally successful and the data still needs uploading
+        """
+        
+        counts = {'patients': 0, 'observations': 0, 'medications': 0}
+        digest = None
+        
+        # Other resource types would only earn a 4xx
+        if _declares_other_resource(data):
+            return FileResult(False, counts, skipped='not a FHIR Bundle'), None
+        
+        if uploaded is not None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if uploaded.get(str(file_path.resolve())) == digest:
+                return FileResult(True, counts, digest, skipped='already uploaded'), None
+        
+        try:
+            bundle = _json_loads(data) if count_resources else None
+        except Exception as e:
+            print(f"  Error processing file {file_path.name}: {str(e)}")
+            return FileResult(False, counts, digest), None
+        
+        # Reject malformed bundles before they cost a round trip
+        if bundle is not None and _validate_bundle is not None:
+            try:
+                _validate_bundle(bundle)
+            except ValueError as e:
+                print(f"  Invalid bundle {file_path.name}: {str(e)}")
+                return FileResult(False, counts, digest), None
+        
+        # Count resources from the parsed bundle
+        if bundle is not None:
+            try:
+                _count_resources((entry['resource'] for entry in bundle.get('entry', [])), counts)
+            except (AttributeError, KeyError, TypeError):
+                pass
+        
+        return FileResult(True, counts, digest), bundle
+    
+    def _upload_bundle_data(self,
+                            file_path: Path,
+                            data,
+                            count_resources: bool,
+                            uploaded: Optional[Dict[str, str]]) -> FileResult:
+        """
+        Filter, validate, count and upload the contents of one bundle file
+        
+        Args:
+            file_path: Path the data was read from
+            data: File contents as bytes or a read-only mmap
+            count_resources: See _upload_file
+            uploaded: See _upload_file
+            
+        Returns:
+            FileResult for the file
+        """
+        
+        prepared, bundle = self._prepare_bundle_data(file_path, data, count_resources, uploaded)
+        if prepared.skipped or not prepared.success:
+            return prepared
+        
+        # Upload the original bytes; no need to re-serialize the parsed bundle
+        result = self.upload_bundle(data, file_path.name)
+        
+        return prepared._replace(success=result is not None,
+                                 response_id=result.get('id') if result else None)
+    
+    def _upload_merged(self,
+                       file_paths: List[Path],
+                       uploaded: Optional[Dict[str, str]] = None) -> List[FileResult]:
+        """
+        Upload a group of bundle files, merging small transactions into one POST
+        
+        Transactions are merged up to merge_max_bytes at a time. Files larger than
+        MERGE_FILE_MAX_BYTES, skipped, invalid, not transactions or whose entry is
+        not a list are handled on their own; transactions read before such a file
+        are sent first, so files reach the server in order.
+        
+        Args:
+            file_paths: Bundle JSON files, in upload order
+            uploaded: See _upload_file
+            
+        Returns:
+            FileResult for each file, in the same order
+        """
+        
+        results = []
+        pending = []  # (position in results, file path, file data, parsed bundle)
+        pending_bytes = 0
+        
+        for file_path in file_paths:
+            try:
+                with open(file_path, 'rb') as f:
+                    # Sized from the open file, so planning needs no stat per file
+                    size = os.fstat(f.fileno()).st_size
+                    data = f.read() if size <= MERGE_FILE_MAX_BYTES else None
+            except OSError as e:
+                print(f"  Error processing file {file_path.name}: {str(e)}")
+                results.append(FileResult(False, {'patients': 0, 'observations': 0, 'medications': 0}))
+                continue
+            
+            if data is None:
+                # Too large to merge; upload it on its own, after the files before it
+                self._send_merged(pending, results)
+                pending, pending_bytes = [], 0
+                results.append(self._upload_file(file_path, True, uploaded))
+                continue
+            
+            if pending and pending_bytes + size > self.merge_max_bytes:
+                self._send_merged(pending, results)
+                pending, pending_bytes = [], 0
+            
+            prepared, bundle = self._prepare_bundle_data(file_path, data, True, uploaded)
+            
+            if not prepared.skipped and prepared.success:
+                if (isinstance(bundle, dict) and bundle.get('type') == 'transaction'
+                        and isinstance(bundle.get('entry', []), list)):
+                    pending.append((len(results), file_path, data, bundle))
+                    pending_bytes += size
+                else:
+                    # Batch bundles would change meaning inside a transaction, and
+                    # a malformed entry (unchecked without fastjsonschema) can't be merged
+                    self._send_merged(pending, results)
+                    pending, pending_bytes = [], 0
+                    result = self.upload_bundle(data, file_path.name)
+                    prepared = prepared._replace(success=result is not None,
+                                                 response_id=result.get('id') if result else None)
+            
+            results.append(prepared)
+        
+        self._send_merged(pending, results)
+        return results
+    
+    def _send_merged(self, pending: List[Tuple], results: List[FileResult]) -> None:
+        """
+        POST pending transaction bundles as one transaction and record each file's result
+        
+        If the server rejects the merged transaction outright (any 4xx other
+        than 429), its files are retried one by one so a single bad or oversized
+        bundle only fails itself. A timeout, lost connection, 5xx or persistent
+        429 may have been applied, so the files are marked failed and a rerun
+        resends the same merged transaction under the same idempotency key.
+        
+        Args:
+            pending: (position in results, file path, file data, parsed bundle) tuples
+            results: Per-file results, updated in place at each pending position
+        """
+        
+        if not pending:
+            return
+        
+        response = None
+        split = len(pending) == 1
+        if len(pending) > 1:
+            entries = [entry for _, _, _, bundle in pending for entry in bundle.get('entry', [])]
+            status, response = self._post_bundle(
+                {'resourceType': 'Bundle', 'type': 'transaction', 'entry': entries},
+                f"merged transaction of {len(pending)} bundles"
+            )
+            # Any 4xx but 429 means the transaction was refused, not committed
+            # (413 included, when the merged body is over a proxy's limit)
+            if response is None and status is not None and 400 <= status < 500 and status != 429:
+                print(f"  Merged transaction of {len(pending)} bundles rejected, uploading them separately")
+                split = True
+            elif response is None:
+                # A timeout or 5xx may still have been committed; re-posting the files
+                # under their own idempotency keys could apply them twice
+                print(f"  Merged transaction of {len(pending)} bundles may not have been applied; "
+                      f"marking them failed so a rerun resends the same transaction")
+                for position, _, _, _ in pending:
+                    results[position] = results[position]._replace(success=False)
+                return
+        
+        if split:
+            for position, file_path, data, _ in pending:
+                result = self.upload_bundle(data, file_path.name)
+                results[position] = results[position]._replace(
+                    success=result is not None,
+                    response_id=result.get('id') if result else None
+                )
+            return
+        
+        # Response entries line up with the merged request entries
+        response_entries = response.get('entry', [])
+        offset = 0
+        for position, _, _, bundle in pending:
+            size = len(bundle.get('entry', []))
+            statuses = [str(entry.get('response', {}).get('status', ''))
+                        for entry in response_entries[offset:offset + size]]
+            offset += size
+            
+            success = len(statuses) == size and all(status.startswith('2') for status in statuses)
+            results[position] = results[position]._replace(success=success, response_id=response.get('id'))
+    
+    def _upload_unit(self,
+                     file_paths: List[Path],
+                     count_resources: bool = True,
+                     uploaded: Optional[Dict[str, str]] = None) -> List[FileResult]:
+        """Upload one planned unit of work: a single file or a group to merge"""
+        
+        if len(file_paths) == 1:
+            return [self._upload_file(file_paths[0], count_resources, uploaded)]
+        return self._upload_merged(file_paths, uploaded)
+    
+    def _plan_units(self, entries: List[os.DirEntry], directory: Path) -> List[List[Path]]:
+        """
+        Group consecutive JSON files for merged upload; other files stand alone
+        
+        Sizes are not known here (a stat per file would delay the first upload
+        on large directories); _upload_merged checks them as it reads the files.
+        
+        Args:
+            entries: Directory entries of the bundle files, in upload order
+            directory: Directory the entries belong to
+            
+        Returns:
+            Lists of file paths, each uploaded by one worker
+        """
+        
+        # Smaller groups on small directories so every worker gets some
+        group_files = max(1, min(MERGE_GROUP_MAX_FILES, len(entries) // self.workers))
+        
+        units = []
+        group = []
+        
+        for entry in entries:
+            file_path = directory / entry.name
+            
+            if not entry.name.endswith('.json'):
+                # Close the open group first so files keep their order
+                if group:
+                    units.append(group)
+                    group = []
+                units.append([file_path])
+                continue
+            
+            group.append(file_path)
+            if len(group) == group_files:
+                units.append(group)
+                group = []
+        
+        if group:
+            units.append(group)
+        
+        return units
+    
+    def upload_directory(self, directory: Path, count_resources: bool = True) -> Dict[str, int]:
         """
         Upload all FHIR bundles from a directory
         
         Args:
-            directory: Directory containing FHIR bundle JSON files
+            directory: Directory containing FHIR bundle JSON and NDJSON files
+            count_resources: Parse bundles to validate them and report resource
+                totals; disable to upload JSON files without parsing them
             
         Returns:
             Dictionary with upload statistics
         """
         
-        bundle_files = sorted(list(directory.glob("*.json")))
-        total_files = len(bundle_files)
+        # scandir gets names and file types from one directory read
+        with os.scandir(directory) as it:
+            entries = sorted(
+                (entry for entry in it
+                 if entry.name.endswith(('.json', '.ndjson')) and entry.is_file()),
+                key=lambda entry: entry.name
+            )
+        total_files = len(entries)
+        
+        # Small transaction bundles share one POST; merging needs them parsed
+        if count_resources and self.merge_max_bytes:
+            units = self._plan_units(entries, directory)
+        else:
+            units = [[directory / entry.name] for entry in entries]
         
         print(f"\nUploading {total_files} bundles from {directory}")
         print("=" * 70)
@@ -173,46 +902,66 @@ class FHIRUploader:
             'total': total_files,
             'successful': 0,
             'failed': 0,
+            'skipped': 0,
             'patients': 0,
             'observations': 0,
             'medications': 0
         }
         
-        for idx, file_path in enumerate(bundle_files, 1):
-            print(f"[{idx}/{total_files}] Uploading {file_path.name}...", end=" ")
-            
-            # Count resources in bundle
-            try:
-                with open(file_path, 'r') as f:
-                    bundle = json.load(f)
+        # Checkpoint of files uploaded to this server by earlier runs
+        state = self._open_state()
+        uploaded = dict(state.execute(
+            "SELECT path, digest FROM uploads WHERE base_url = ?", (self.base_url,)
+        )) if state else None
+        
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # map() yields results in file order while uploads run concurrently
+                unit_results = executor.map(self._upload_unit, units,
+                                            repeat(count_resources), repeat(uploaded))
+                results = (
+                    (file_path, result)
+                    for unit, unit_result in zip(units, unit_results)
+                    for file_path, result in zip(unit, unit_result)
+                )
                 
-                for entry in bundle.get('entry', []):
-                    resource_type = entry['resource'].get('resourceType')
-                    if resource_type == 'Patient':
-                        stats['patients'] += 1
-                    elif resource_type == 'Observation':
-                        stats['observations'] += 1
-                    elif resource_type == 'MedicationStatement':
-                        stats['medications'] += 1
-            except:
-                pass
-            
-            # Upload
-            success = self.upload_bundle_file(file_path)
-            
-            if success:
-                stats['successful'] += 1
-                print("✓")
-            else:
-                stats['failed'] += 1
-                print("✗")
-            
-            # Progress update
-            if idx % self.batch_size == 0:
-                print(f"  Progress: {stats['successful']} successful, {stats['failed']} failed")
-            
-            # Rate limiting delay
-            time.sleep(self.delay_seconds)
+                # Status lines are buffered and written once per batch
+                status_lines = []
+                
+                for idx, (file_path, result) in enumerate(results, 1):
+                    for key, value in result.counts.items():
+                        stats[key] += value
+                    
+                    if result.skipped:
+                        stats['skipped'] += 1
+                        status_lines.append(f"[{idx}/{total_files}] {file_path.name} (skipped: {result.skipped})\n")
+                    elif result.success:
+                        stats['successful'] += 1
+                        status_lines.append(f"[{idx}/{total_files}] {file_path.name} ✓\n")
+                        if state:
+                            state.execute(
+                                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                                (self.base_url, str(file_path.resolve()), result.digest,
+                                 result.response_id, time.time())
+                            )
+                    else:
+                        stats['failed'] += 1
+                        status_lines.append(f"[{idx}/{total_files}] {file_path.name} ✗\n")
+                    
+                    # Progress update
+                    if idx % self.batch_size == 0:
+                        status_lines.append(f"  Progress: {stats['successful']} successful, {stats['failed']} failed\n")
+                        sys.stdout.write(''.join(status_lines))
+                        sys.stdout.flush()
+                        status_lines.clear()
+                        if state:
+                            state.commit()
+                
+                sys.stdout.write(''.join(status_lines))
+        finally:
+            if state:
+                state.commit()
+                state.close()
         
         # Final summary
         print("\n" + "=" * 70)
@@ -220,10 +969,12 @@ class FHIRUploader:
         print(f"  Total bundles: {stats['total']}")
         print(f"  Successful: {stats['successful']} ({stats['successful']/stats['total']*100:.1f}%)")
         print(f"  Failed: {stats['failed']}")
-        print(f"\nResources uploaded:")
-        print(f"  Patients: {stats['patients']}")
-        print(f"  Observations: {stats['observations']}")
-        print(f"  Medications: {stats['medications']}")
+        print(f"  Skipped: {stats['skipped']}")
+        if count_resources:
+            print(f"\nResources uploaded:")
+            print(f"  Patients: {stats['patients']}")
+            print(f"  Observations: {stats['observations']}")
+            print(f"  Medications: {stats['medications']}")
         
         return stats
     
@@ -239,17 +990,18 @@ class FHIRUploader:
         """
         
         try:
-            response = self.session.get(
+            response = self.pool.request(
+                'GET',
                 f"{self.base_url}/Patient",
+                fields=params or {},
                 headers=self._get_headers(),
-                params=params or {},
                 timeout=10
             )
             
-            if response.status_code == 200:
-                return response.json()
+            if response.status == 200:
+                return _json_loads(response.data)
             else:
-                print(f"Search failed: {response.status_code}")
+                print(f"Search failed: {response.status}")
                 return None
                 
         except Exception as e:
@@ -267,6 +1019,10 @@ def main():
     client_id = os.getenv('HTTP_CLIENT_ID')
     client_secret = os.getenv('HTTP_CLIENT_SECRET')
     processed_fhir_dir = os.getenv('PROCESSED_FHIR_DIR', './processed_fhir')
+    upload_workers = int(os.getenv('UPLOAD_WORKERS', '8'))
+    upload_state_file = os.getenv('UPLOAD_STATE_FILE', '.fhir_upload.state')
+    upload_gzip_min_bytes = int(os.getenv('UPLOAD_GZIP_MIN_BYTES', '4096'))
+    upload_merge_max_bytes = int(os.getenv('UPLOAD_MERGE_MAX_BYTES', '1000000'))
     
     if not all([hostname, client_id, client_secret]):
         print("Error: Missing environment variables")
@@ -283,7 +1039,11 @@ def main():
         client_id=client_id,
         client_secret=client_secret,
         batch_size=10,
-        delay_seconds=0.5
+        delay_seconds=0.5,
+        workers=upload_workers,
+        state_path=upload_state_file or None,
+        gzip_min_bytes=upload_gzip_min_bytes,
+        merge_max_bytes=upload_merge_max_bytes
     )
     
     # Test connection